@@ -1,17 +1,48 @@
 from flask import Flask, request
 from twilio.twiml.messaging_response import MessagingResponse
 from twilio.rest import Client
+from twilio.http.http_client import TwilioHttpClient
+from twilio.base.exceptions import TwilioRestException
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 from openai import OpenAI
+import httpx
 import os
-import json
+import sys
+import logging
+import orjson
+import uuid
+import random
+import time
 from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+from concurrent.futures import ThreadPoolExecutor
 import re
 from dotenv import load_dotenv
 
+# Stored reminder jobs point at "app:send_whatsapp_message". Running this file as __main__
+# would import it a second time as "app" and start a second scheduler on the same job store.
+if __name__ == "__main__":
+    sys.exit("Run with: flask --app app run --host 0.0.0.0 --port 5000 (or gunicorn -c gunicorn.conf.py app:app)")
+
 # Load environment variables from .env file
 load_dotenv()
 
+# Log level from .env (INFO by default); DEBUG messages cost nothing unless enabled
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+# Library loggers are chatty at INFO (Twilio logs every request URL and header, httpx and
+# APScheduler every call/job run); keep only their warnings so sends stay off the log hot path
+for noisy_logger in ("twilio.http_client", "httpx", "apscheduler"):
+    logging.getLogger(noisy_logger).setLevel(logging.WARNING)
+
 app = Flask(__name__)
 
 # ────────────────────────────────────────────────
@@ -22,6 +53,7 @@ TWILIO_AUTH_TOKEN  = os.getenv("TWILIO_AUTH_TOKEN")
 TWILIO_WHATSAPP_NUMBER = os.getenv("TWILIO_WHATSAPP_NUMBER", "whatsapp:+14155238886")
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4.1-nano")
 EMERGENCY_CONTACT = os.getenv("EMERGENCY_CONTACT")
 
 # Check required env vars
@@ -33,69 +65,92 @@ if missing:
 # ────────────────────────────────────────────────
 #           TIMEZONE CONFIG
 # ────────────────────────────────────────────────
-UTC_OFFSET_HOURS = int(os.getenv("UTC_OFFSET_HOURS", "7"))
-TIMEZONE_LABEL = os.getenv("TIMEZONE_LABEL", "WIB")
+# UTC_OFFSET_HOURS / TIMEZONE_LABEL are no longer used; refuse to silently fall back to Jakarta time
+legacy_tz = [var for var in ("UTC_OFFSET_HOURS", "TIMEZONE_LABEL") if os.getenv(var)]
+if legacy_tz and not os.getenv("TZ_NAME"):
+    raise ValueError(
+        f"{', '.join(legacy_tz)} is no longer supported; set TZ_NAME to an IANA time zone instead "
+        "(e.g. TZ_NAME=Asia/Jakarta for UTC+7, TZ_NAME=Asia/Kolkata for UTC+5:30)"
+    )
+TZ_NAME = os.getenv("TZ_NAME", "Asia/Jakarta")
+LOCAL_TZ = ZoneInfo(TZ_NAME)
+
+# Emergency keywords (English + Indonesian), matched anywhere in the lowercased message so that
+# inflections and run-together words ("chest pains", "painful", "emergencies", "helpme") still alert.
+# A missed alert is worse than a false one, so keep this at least as broad as plain substring matching.
+# Phone keyboards often send a curly apostrophe (U+2019) in "can't".
+# Indonesian "tolong" also means "please", so it only counts as a distress call on its own,
+# with "!" or as "tolong saya/aku":
+#   "tolong ingatkan saya minum obat jam 8" -> no alert (normal reminder request)
+#   "tolong!", "tolong saya", "Tolong"       -> alert
+EMERGENCY_RE = re.compile(
+    r"emergenc|help|urgent|pain|chest pain|can[’']?t breathe|darurat|sakit dada"
+    r"|tolong\s*!|tolong (?:saya|aku)\b|^\W*tolong\W*$"
+)
+
+# Reminder time from the LLM: 24-hour HH:MM, rejecting impossible values like 25:99
+TIME_RE = re.compile(r"^([01]\d|2[0-3]):[0-5]\d$")
+
+# Static part of the system prompt. Kept identical across requests so OpenAI can reuse its prompt cache.
+SYSTEM_PROMPT_PREFIX = (
+    "You are a kind health assistant for elderly. Always reply in simple, warm English.\n"
+    "Keep each reply short: two or three sentences.\n"
+    "Reminder times are in the user's local time zone given below.\n"
+    "Output ONLY valid JSON with this structure:\n"
+    "{\n"
+    '  "reply": "your message",\n'
+    '  "reminder": {"time": "HH:MM", "message": "..."} or null\n'
+    "}"
+)
 
 # Files for storage
 SCHEDULES_FILE = "schedules.json" # Diisi oleh dev
-REMAINDER_FILE = "remainder.json" # Hasil buat baru dari chat
+REMINDER_DB_URL = os.getenv("REMINDER_DB_URL", "sqlite:///reminders.db") # Pengingat dari chat (job store)
+DEAD_LETTER_FILE = "failed_messages.jsonl" # Pesan yang gagal terkirim setelah semua retry
+
+# Twilio send retries, with exponential backoff. Sending is a POST that is not safe to repeat,
+# so only retry when Twilio clearly refused the request (rate limit / unavailable)
+RETRYABLE_TWILIO_STATUS = {429, 503}
+TWILIO_RETRY_DELAYS = (1, 4, 16) # seconds before each retry (jittered), so at most 4 attempts
+
+# Background workers that handle OpenAI + Twilio calls outside the webhook
+LLM_WORKERS = int(os.getenv("LLM_WORKERS", "8"))
+
+# Daily reminder recipients (comma-separated), and how many of their sends may run at once
+DAILY_REMINDER_RECIPIENTS = [
+    number.strip()
+    for number in (os.getenv("DAILY_REMINDER_RECIPIENTS") or EMERGENCY_CONTACT).split(",")
+    if number.strip()
+]
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "10"))
 
 # ────────────────────────────────────────────────
 #           GLOBAL VARIABLES
 # ────────────────────────────────────────────────
-twilio_client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
+# Keep-alive connection pools, so outbound calls reuse TLS sessions instead of a new handshake each time
+twilio_http = TwilioHttpClient(pool_connections=True, timeout=10) # seconds; a stalled call must not hold a worker forever
+twilio_http.session.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=128))
+twilio_client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, http_client=twilio_http)
 
-# Custom reminders from chat
-user_reminders = {}
+openai_http = httpx.Client(
+    http2=True,
+    timeout=httpx.Timeout(30.0, connect=5.0),
+    limits=httpx.Limits(max_keepalive_connections=32, max_connections=128)
+)
+openai_client = OpenAI(api_key=OPENAI_API_KEY, http_client=openai_http)
 
-# Scheduler for reminders
-scheduler = BackgroundScheduler()
-scheduler.start()
+# Scheduler for reminders: custom reminders from chat persist in the database,
+# daily schedules and emergency follow-ups stay in memory
+scheduler = BackgroundScheduler(jobstores={"reminders": SQLAlchemyJobStore(url=REMINDER_DB_URL)})
 
-# ────────────────────────────────────────────────
-#           PERSISTENCE HELPERS (JSON)
-# ────────────────────────────────────────────────
+# Job queue for chat replies (OpenAI + Twilio), so Twilio gets its webhook ack right away
+executor = ThreadPoolExecutor(max_workers=LLM_WORKERS, thread_name_prefix="llm-worker")
 
-def load_user_reminders_from_file():
-    """Memuat pengingat kustom dari remainder.json saat startup"""
-    global user_reminders
-    try:
-        if os.path.exists(REMAINDER_FILE):
-            with open(REMAINDER_FILE, 'r') as f:
-                data = json.load(f)
-                for user_number, reminders in data.items():
-                    user_reminders[user_number] = []
-                    for rem in reminders:
-                        # Ensure loaded datetime is timezone-aware (UTC)
-                        dt = datetime.fromisoformat(rem["time"])
-                        if dt.tzinfo is None:
-                            dt = dt.replace(tzinfo=timezone.utc)
-                            
-                        user_reminders[user_number].append({
-                            "time": dt,
-                            "message": rem["message"]
-                        })
-            print(f"Loaded existing reminders from {REMAINDER_FILE}")
-    except Exception as e:
-        print(f"Error loading {REMAINDER_FILE}: {e}")
+# Dedicated pool for emergency alerts, so an alert never waits behind queued chat replies
+alert_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="alert")
 
-def save_user_reminders_to_file():
-    """Menyimpan pengingat kustom ke remainder.json agar permanen"""
-    try:
-        data_to_save = {}
-        for user_number, reminders in user_reminders.items():
-            data_to_save[user_number] = []
-            for rem in reminders:
-                # Ensure time is saved as an explicit UTC ISO string
-                data_to_save[user_number].append({
-                    "time": rem["time"].astimezone(timezone.utc).isoformat(),
-                    "message": rem["message"]
-                })
-        with open(REMAINDER_FILE, 'w') as f:
-            json.dump(data_to_save, f, indent=4)
-    except Exception as e:
-        print(f"Error saving to {REMAINDER_FILE}: {e}")
+# Separate pool for broadcasts, so a large fan-out is capped (Twilio rate limits) and never starves chat replies
+broadcast_executor = ThreadPoolExecutor(max_workers=BROADCAST_CONCURRENCY, thread_name_prefix="broadcast")
 
 # ────────────────────────────────────────────────
 #           LOAD REGULAR DAILY SCHEDULES
@@ -105,8 +160,8 @@ def load_regular_schedules():
     """Load daily schedules from schedules.json (Developer-defined)"""
     try:
         if os.path.exists(SCHEDULES_FILE):
-            with open(SCHEDULES_FILE, 'r') as f:
-                data = json.load(f)
+            with open(SCHEDULES_FILE, 'rb') as f:
+                data = orjson.loads(f.read())
             schedules = data.get("global_daily_reminders", [])
 
             for sched in schedules:
@@ -129,59 +184,165 @@ def load_regular_schedules():
                         id=f"daily_{sched['message'][:20]}",
                         replace_existing=True
                     )
-                    print(f"Scheduled daily reminder: {time_utc_str} UTC")
+                    logger.info("Scheduled daily reminder: %s UTC", time_utc_str)
                 except Exception as e:
-                    print(f"Error scheduling {sched}: {e}")
+                    logger.error("Error scheduling %s: %s", sched, e)
     except Exception as e:
-        print(f"Error loading {SCHEDULES_FILE}: {e}")
+        logger.error("Error loading %s: %s", SCHEDULES_FILE, e)
 
 def send_regular_reminder(message):
-    """Send daily reminder to emergency contact"""
-    send_whatsapp_message(EMERGENCY_CONTACT, message)
+    """Send daily reminder to every configured recipient"""
+    broadcast_message(DAILY_REMINDER_RECIPIENTS, message)
 
 # ────────────────────────────────────────────────
 #           HELPER FUNCTIONS
 # ────────────────────────────────────────────────
 
-def send_whatsapp_message(to_number, body):
+def _is_retryable_send_error(e):
+    """Retry only if Twilio never got the message: a refusal, or a connection that was never opened.
+    Read timeouts and other 5xx errors may mean the message was already accepted, so resending
+    them could deliver a reminder (e.g. medicine) twice."""
+    if isinstance(e, TwilioRestException):
+        return e.status in RETRYABLE_TWILIO_STATUS
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(e, requests.exceptions.ConnectionError):
+        # requests wraps urllib3's MaxRetryError; NewConnectionError means no bytes were sent
+        reason = getattr(e.args[0], "reason", None) if e.args else None
+        return isinstance(reason, NewConnectionError)
+    return False
+
+def record_failed_message(to_number, body, error):
+    """Append a message that could not be delivered to the dead-letter file"""
     try:
-        twilio_client.messages.create(
-            from_=TWILIO_WHATSAPP_NUMBER,
-            body=body,
-            to=to_number
-        )
-        print(f"Message sent to {to_number}")
+        entry = {
+            "time": datetime.now(timezone.utc),
+            "to": to_number,
+            "body": body,
+            "error": str(error)
+        }
+        with open(DEAD_LETTER_FILE, 'ab') as f:
+            f.write(orjson.dumps(entry) + b"\n")
     except Exception as e:
-        print(f"Failed to send to {to_number}: {e}")
+        logger.error("Error writing to %s: %s", DEAD_LETTER_FILE, e)
+
+def send_whatsapp_message(to_number, body):
+    """Send a WhatsApp message, retrying refused or unconnected sends with exponential backoff"""
+    for attempt, delay in enumerate((*TWILIO_RETRY_DELAYS, None), start=1):
+        try:
+            twilio_client.messages.create(
+                from_=TWILIO_WHATSAPP_NUMBER,
+                body=body,
+                to=to_number
+            )
+            logger.info("Message sent to %s", to_number)
+            return
+        except Exception as e:
+            if delay is None or not _is_retryable_send_error(e):
+                logger.error("Failed to send to %s: %s", to_number, e)
+                record_failed_message(to_number, body, e)
+                return
+            wait = delay * random.uniform(0.5, 1.5)
+            logger.warning("Send to %s failed (attempt %d): %s – retrying in %.1fs", to_number, attempt, e, wait)
+            time.sleep(wait)
+
+def broadcast_message(recipients, body):
+    """Send the same message to many numbers concurrently, at most BROADCAST_CONCURRENCY at a time"""
+    for to_number in recipients:
+        broadcast_executor.submit(send_whatsapp_message, to_number, body)
 
 def send_followup(to_number):
     """Helper function for emergency follow-up messages"""
     send_whatsapp_message(to_number, "Are you okay? Please reply if you can. ❤️")
 
-def check_and_send_reminders():
-    """Check due custom reminders and update remainder.json if sent"""
-    now_utc = datetime.now(timezone.utc)
-    changed = False
-    for user_number, reminders in list(user_reminders.items()):
-        remaining = []
-        for rem in reminders:
-            # Compare using timezone-aware UTC objects
-            if rem["time"] <= now_utc:
-                send_whatsapp_message(user_number, rem["message"])
-                changed = True
-            else:
-                remaining.append(rem)
-        user_reminders[user_number] = remaining
-    
-    if changed:
-        save_user_reminders_to_file()
-
-# Schedule the check every 1 minute
-scheduler.add_job(check_and_send_reminders, 'interval', minutes=1)
-
-# Startup sequence: Load schedules and existing reminders
+def add_user_reminder(user_number, remind_utc, message):
+    """Store a custom reminder as a one-shot job in the persistent reminder job store"""
+    scheduler.add_job(
+        "app:send_whatsapp_message", # fixed text reference, independent of how the app was started
+        'date',
+        run_date=remind_utc,
+        args=[user_number, message],
+        id=f"rem_{user_number}_{uuid.uuid4().hex}",
+        jobstore="reminders",
+        misfire_grace_time=None # reminders missed while the bot was down are still sent on startup
+    )
+    logger.info("Reminder set for %s at %s", user_number, remind_utc)
+    # Counting stored reminders is a database query, so only do it when DEBUG is on
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Active custom reminders: %d", len(scheduler.get_jobs(jobstore="reminders")))
+
+# Startup sequence: Load daily schedules, then start the scheduler.
+# Started only after the job functions above exist, since stored reminder jobs are loaded by reference.
 load_regular_schedules()
-load_user_reminders_from_file()
+scheduler.start()
+
+# ────────────────────────────────────────────────
+#           BACKGROUND JOBS
+# ────────────────────────────────────────────────
+
+def process_llm_reply(from_number, incoming_msg):
+    """Ask OpenAI for a reply, set any reminder, and send the answer as a new WhatsApp message"""
+    response_text = "Sorry, I didn't quite understand. Could you try again? 😊"
+
+    try:
+        current_user_time = datetime.now(LOCAL_TZ)
+        current_str = current_user_time.strftime("%H:%M %Y-%m-%d %Z")
+
+        # Only the time changes per request; it goes after the static prefix
+        system_prompt = SYSTEM_PROMPT_PREFIX + f"\nCurrent user time: {current_str}\nTimezone: {TZ_NAME}"
+
+        completion = openai_client.chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": incoming_msg}
+            ],
+            # Short, focused replies: output length drives most of the latency.
+            # 200 leaves room for the reminder object after a 2-3 sentence reply.
+            max_completion_tokens=200,
+            temperature=0.3,
+            top_p=0.9,
+            response_format={"type": "json_object"}
+        )
+
+        choice = completion.choices[0]
+        if choice.finish_reason == "length":
+            # The JSON is truncated, so parsing below fails and any requested reminder is lost
+            logger.warning("OpenAI reply for %s was cut off at max_completion_tokens: %r", from_number, choice.message.content)
+
+        parsed = orjson.loads(choice.message.content)
+        response_text = parsed.get("reply", "I'm here to help! 😊")
+
+        reminder_data = parsed.get("reminder")
+        if reminder_data and isinstance(reminder_data, dict):
+            time_str = reminder_data.get("time")
+            msg = reminder_data.get("message", "Reminder! 😊")
+
+            if time_str and TIME_RE.match(time_str):
+                try:
+                    hour, minute = map(int, time_str.split(":"))
+                    
+                    # 1. Calculate the requested time in user's local time
+                    remind_local = current_user_time.replace(hour=hour, minute=minute, second=0, microsecond=0)
+                    
+                    # 2. If that time has already passed today, schedule for tomorrow
+                    if remind_local < current_user_time:
+                        remind_local += timedelta(days=1)
+
+                    # 3. Convert to UTC for the scheduler (DST-safe via the zone rules)
+                    remind_utc = remind_local.astimezone(timezone.utc)
+
+                    add_user_reminder(from_number, remind_utc, msg)
+                    
+                    response_text += f"\n\n(Reminder set for {time_str} {remind_local.tzname()} 😊)"
+                except Exception as e:
+                    logger.error("Reminder error: %s", e)
+
+    except Exception:
+        logger.exception("Error handling message from %s", from_number)
+        response_text = "I got a bit confused. Could you say that again? 😅"
+
+    send_whatsapp_message(from_number, response_text)
 
 # ────────────────────────────────────────────────
 #                MAIN WEBHOOK
@@ -194,15 +355,14 @@ def whatsapp_webhook():
     profile_name = request.values.get("ProfileName", "User")
 
     resp = MessagingResponse()
-    response_text = "Sorry, I didn't quite understand. Could you try again? 😊"
-
-    lower_msg = incoming_msg.lower()
 
     # Emergency detection
-    emergency_keywords = ["emergency", "help", "urgent", "pain", "chest pain", "can't breathe"]
-    if any(word in lower_msg for word in emergency_keywords):
+    lower_msg = incoming_msg.lower()
+    if EMERGENCY_RE.search(lower_msg):
         alert_text = f"!!! EMERGENCY ALERT !!!\nFrom: {profile_name} ({from_number})\nMessage: {incoming_msg}"
-        send_whatsapp_message(EMERGENCY_CONTACT, alert_text)
+        # Sent in the background on its own pool: the webhook never waits on Twilio's API,
+        # and the alert never queues behind slow LLM replies
+        alert_executor.submit(send_whatsapp_message, EMERGENCY_CONTACT, alert_text)
         
         # Automated follow-up every 3 minutes for 1 hour
         scheduler.add_job(
@@ -218,80 +378,10 @@ def whatsapp_webhook():
         
         response_text = "I've sent an urgent message to your emergency contact. Please stay calm. ❤️"
         response_text += "\nI'll check on you every 3 minutes. Just reply 'OK' or tell me how you're feeling."
+        resp.message(response_text)
 
     else:
-        try:
-            now_utc = datetime.now(timezone.utc)
-            current_user_time = now_utc + timedelta(hours=UTC_OFFSET_HOURS)
-            current_str = current_user_time.strftime("%H:%M %Y-%m-%d") + f" {TIMEZONE_LABEL}"
-
-            system_prompt = (
-                f"The user is in {TIMEZONE_LABEL}. Current time is {current_str}.\n"
-                "You are a kind health assistant for elderly. Always reply in simple, warm English.\n"
-                "Output ONLY valid JSON with this structure:\n"
-                "{\n"
-                '  "reply": "your message",\n'
-                '  "reminder": {"time": "HH:MM", "message": "..."} or null\n'
-                "}"
-            )
+        # OpenAI + Twilio run in the background; the reply arrives as a separate message
+        executor.submit(process_llm_reply, from_number, incoming_msg)
 
-            completion = openai_client.chat.completions.create(
-                model="gpt-4.1-nano",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": incoming_msg}
-                ],
-                temperature=0.6,
-                response_format={"type": "json_object"}
-            )
-
-            parsed = json.loads(completion.choices[0].message.content)
-            response_text = parsed.get("reply", "I'm here to help! 😊")
-
-            reminder_data = parsed.get("reminder")
-            if reminder_data and isinstance(reminder_data, dict):
-                time_str = reminder_data.get("time")
-                msg = reminder_data.get("message", "Reminder! 😊")
-
-                if time_str and re.match(r"^\d{2}:\d{2}$", time_str):
-                    try:
-                        hour, minute = map(int, time_str.split(":"))
-                        
-                        # 1. Calculate the requested time in user's local time
-                        remind_local = current_user_time.replace(hour=hour, minute=minute, second=0, microsecond=0)
-                        
-                        # 2. Convert that local time back to UTC by subtracting the offset
-                        remind_utc = remind_local - timedelta(hours=UTC_OFFSET_HOURS)
-
-                        # 3. If the calculated UTC time is already in the past, schedule for tomorrow
-                        if remind_utc < now_utc:
-                            remind_utc += timedelta(days=1)
-
-                        if from_number not in user_reminders:
-                            user_reminders[from_number] = []
-
-                        user_reminders[from_number].append({
-                            "time": remind_utc, 
-                            "message": msg
-                        })
-                        
-                        # Save to remainder.json immediately
-                        save_user_reminders_to_file()
-                        
-                        response_text += f"\n\n(Reminder set for {time_str} {TIMEZONE_LABEL} 😊)"
-                    except Exception as e:
-                        print(f"Reminder error: {e}")
-
-        except Exception as e:
-            print("Error:", e)
-            response_text = "I got a bit confused. Could you say that again? 😅"
-
-    resp.message(response_text)
     return str(resp)
-
-# ────────────────────────────────────────────────
-#                RUN SERVER
-# ────────────────────────────────────────────────
-
-if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
\ No newline at end of file
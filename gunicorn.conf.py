@@ -0,0 +1,14 @@
+# Production server config: gunicorn -c gunicorn.conf.py app:app
+#
+# gevent workers patch socket I/O, so requests waiting on Twilio/OpenAI
+# yield to each other instead of blocking the whole worker.
+#
+# Keep a single worker: the APScheduler instance runs inside the app process,
+# so every extra worker would start its own scheduler and send each reminder again.
+# Scale with worker_connections, not workers.
+
+bind = "0.0.0.0:5000"
+worker_class = "gevent"
+workers = 1
+worker_connections = 1000
+timeout = 30